@@ -0,0 +1,238 @@
+import os
+import re
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select, update
+from models import db, Post
+from outbox import handler
+from sharding import shards
+import sharding
+
+
+# Media of the posts
+# Uploaded (or imported) images are saved in MEDIA_ROOT named by the sha256 of their content,
+# so the same image uploaded twice is stored once. After a post is created the outbox worker
+# reads the dimensions and writes one thumbnail per THUMBNAIL_SIZES, which are saved on the
+# post so the feeds can use a small variant instead of the full size image.
+# Remote media (http urls) is validated but not downloaded.
+
+# only files saved by save_media can be used as the media of a post
+MEDIA_FILENAME = re.compile(r'^[0-9a-f]{64}\.(jpg|png|gif|webp)$')
+
+# first bytes of each supported image format
+SIGNATURES = [
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'GIF87a', '.gif'),
+    (b'GIF89a', '.gif'),
+]
+
+
+def detect_extension(data):
+    for signature, extension in SIGNATURES:
+        if data.startswith(signature):
+            return extension
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return '.webp'
+    return None
+
+
+def validate_media_url(media_url):
+    """
+    Returns an error message when media_url is not a valid url, None if it is valid
+    """
+    if not isinstance(media_url, str) or not media_url:
+        return "media_url must be a string"
+    if len(media_url) > Post.media_url.type.length:
+        return "media_url is too long"
+    media_prefix = current_app.config['MEDIA_URL'] + '/'
+    if media_url.startswith(media_prefix):
+        path = local_path(media_url)
+        if path is None or not os.path.exists(path):
+            return "media_url does not exist"
+        return None
+    url = urlparse(media_url)
+    if url.scheme not in ('http', 'https') or not url.netloc:
+        return "media_url must be an http(s) url or an uploaded media url"
+    return None
+
+
+def local_path(media_url):
+    # path of the file for media urls served by this API, None for remote or invalid urls
+    media_prefix = current_app.config['MEDIA_URL'] + '/'
+    if not media_url.startswith(media_prefix):
+        return None
+    filename = media_url[len(media_prefix):]
+    if not MEDIA_FILENAME.match(filename):
+        return None
+    root = os.path.realpath(current_app.config['MEDIA_ROOT'])
+    path = os.path.realpath(os.path.join(root, filename))
+    # the file (or a symlink with that name) must not point outside of MEDIA_ROOT
+    if os.path.dirname(path) != root:
+        return None
+    return path
+
+
+def write_file(path, write):
+    """
+    Call write(file) on a temporary file of the same folder and rename it to path, so a crash
+    or two uploads of the same image at the same time never leave a truncated file at path
+    """
+    file = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='.tmp-', delete=False)
+    try:
+        with file:
+            write(file)
+        # the temporary file is only readable by its owner, the media is public
+        os.chmod(file.name, 0o644)
+        os.replace(file.name, path)
+    except Exception:
+        if os.path.exists(file.name):
+            os.remove(file.name)
+        raise
+
+
+def save_media(data):
+    """
+    Save an image in MEDIA_ROOT and return its url, None if data is not a supported image
+    """
+    extension = detect_extension(data)
+    if extension is None:
+        return None
+    filename = hashlib.sha256(data).hexdigest() + extension
+    root = current_app.config['MEDIA_ROOT']
+    os.makedirs(root, exist_ok=True)
+    path = os.path.join(root, filename)
+    # the name is the hash of the content, if the file exists it is the same image
+    if not os.path.exists(path):
+        write_file(path, lambda file: file.write(data))
+    return current_app.config['MEDIA_URL'] + '/' + filename
+
+
+def process_media(path, thumbnails_dir, sizes):
+    """
+    Read the hash and dimensions of an image and write its thumbnails,
+    it does not use the app or the database so it can run in any thread
+    """
+    with open(path, 'rb') as file:
+        media_hash = hashlib.sha256(file.read()).hexdigest()
+    metadata = {"hash": media_hash, "width": None, "height": None, "variants": {}}
+    try:
+        from PIL import Image
+    except ImportError:
+        # without Pillow only the hash is saved
+        return metadata
+
+    os.makedirs(thumbnails_dir, exist_ok=True)
+    with Image.open(path) as image:
+        metadata["width"], metadata["height"] = image.size
+        for name, size in sizes.items():
+            filename = f"{media_hash}_{name}.jpg"
+            thumbnail_path = os.path.join(thumbnails_dir, filename)
+            # thumbnails are named by hash too, so they are only generated once per image
+            if not os.path.exists(thumbnail_path):
+                thumbnail = image.convert('RGB')
+                thumbnail.thumbnail((size, size))
+                write_file(thumbnail_path, lambda file: thumbnail.save(file, 'JPEG', quality=85))
+            metadata["variants"][name] = filename
+    return metadata
+
+
+def process_many(paths, workers=None):
+    """
+    Process many images on a bounded pool of threads, returns the metadata in the same order
+    """
+    config = current_app.config
+    thumbnails_dir = os.path.join(config['MEDIA_ROOT'], 'thumbnails')
+    with ThreadPoolExecutor(max_workers=workers or config['MEDIA_WORKERS']) as executor:
+        return list(executor.map(
+            lambda path: process_media(path, thumbnails_dir, config['THUMBNAIL_SIZES']), paths))
+
+
+def process_url(media_url):
+    """
+    Process the media if it is stored in MEDIA_ROOT, returns the values of the post columns
+    or None for remote media
+    """
+    path = local_path(media_url)
+    if path is None or not os.path.exists(path):
+        return None
+    config = current_app.config
+    metadata = process_media(path, os.path.join(config['MEDIA_ROOT'], 'thumbnails'),
+                             config['THUMBNAIL_SIZES'])
+    return post_values(metadata)
+
+
+def post_values(metadata):
+    thumbnails_url = current_app.config['MEDIA_URL'] + '/thumbnails/'
+    return {
+        "media_hash": metadata["hash"],
+        "media_width": metadata["width"],
+        "media_height": metadata["height"],
+        "media_variants": {name: thumbnails_url + filename
+                           for name, filename in metadata["variants"].items()},
+    }
+
+
+@handler('post.created')
+@handler('post.media_changed')
+def process_post_media(event):
+    # the outbox worker already runs the handlers on its own pool of threads
+    if shards.enabled:
+        post = sharding.get_post(event["entity_id"])
+        values = post and process_url(post["media_url"])
+        if values:
+            sharding.update_post(event["entity_id"], values)
+        return
+    post = db.session.get(Post, event["entity_id"])
+    values = post and process_url(post.media_url)
+    if values:
+        for key, value in values.items():
+            setattr(post, key, value)
+
+
+@click.command('media-process')
+@click.option('--workers', default=None, type=int, help='Threads processing the images')
+@with_appcontext
+def media_process(workers):
+    """
+    Process the media of all the posts that have not been processed yet
+    """
+    if shards.enabled:
+        stmt = select(sharding.posts.c.id, sharding.posts.c.media_url).where(
+            sharding.posts.c.media_hash.is_(None))
+        posts = [row for rows in shards.scatter(lambda connection: connection.execute(stmt).all())
+                 for row in rows]
+    else:
+        posts = db.session.execute(
+            select(Post.id, Post.media_url).where(Post.media_hash.is_(None))).all()
+    posts = [(post_id, local_path(media_url)) for post_id, media_url in posts
+             if local_path(media_url) and os.path.exists(local_path(media_url))]
+
+    results = process_many([path for _, path in posts], workers)
+    for (post_id, _), metadata in zip(posts, results):
+        if shards.enabled:
+            sharding.update_post(post_id, post_values(metadata))
+        else:
+            db.session.execute(
+                update(Post).where(Post.id == post_id).values(**post_values(metadata)))
+    db.session.commit()
+    click.echo(f"{len(posts)} posts processed")
+
+
+@click.command('media-import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@with_appcontext
+def media_import(path):
+    """
+    Copy a local image to the media folder and print its media_url
+    """
+    with open(path, 'rb') as file:
+        media_url = save_media(file.read())
+    if media_url is None:
+        raise click.ClickException("The file is not a supported image")
+    click.echo(media_url)
@@ -1,7 +1,7 @@
 import enum
 import datetime
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import String, Boolean, Date, Enum, DateTime
+from sqlalchemy import String, Boolean, Date, Enum, DateTime, Integer, JSON, Text, Float
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 db = SQLAlchemy()
@@ -40,6 +40,18 @@ likes = db.Table(
 )
 
 
+# Token buckets of the rate limiter when RATELIMIT_STORAGE is "database", see ratelimit.py
+# one row per client or endpoint, shared by all the workers of the app
+rate_limit_buckets = db.Table(
+    'rate_limit_bucket',
+    db.Column('key', db.String(200), primary_key=True),
+    db.Column('tokens', Float(), nullable=False),
+    db.Column('updated_at', Float(), nullable=False),
+    db.Column('rate', Float(), nullable=False),
+    db.Column('capacity', Float(), nullable=False),
+)
+
+
 class User(db.Model):
     id: Mapped[int] = mapped_column(primary_key=True)
     username: Mapped[str] = mapped_column(
@@ -97,6 +109,14 @@ class User(db.Model):
     def __repr__(self):
         return f"User(id={self.id}, username={self.username})"
 
+    def post_ids(self):
+        # imported here because sharding imports this module
+        from sharding import shards, list_post_ids
+        # with sharding the posts are in the shard of the user, not in this database
+        if shards.enabled:
+            return list_post_ids(self.id)
+        return [post.id for post in self.posts]
+
     # Method that serialize the user object to a dictionary
     # this is used for the API
     def serialize(self):
@@ -109,7 +129,7 @@ class User(db.Model):
             "is_verified": self.is_verified,
             "created_at": self.created_at.isoformat(),
             "updated_at": self.updated_at.isoformat(),
-            "posts": [post.id for post in self.posts],
+            "posts": self.post_ids(),
             "followers": [user.username for user in self.followed_by],
             "following": [user.username for user in self.following],
         }
@@ -125,6 +145,11 @@ class Post(db.Model):
         DateTime(timezone=True), default=datetime.datetime.now)
     user_id: Mapped[int] = mapped_column(
         db.ForeignKey('user.id'), nullable=False)
+    # filled by the media processing after the post is created, see media.py
+    media_hash: Mapped[str] = mapped_column(String(64), nullable=True, index=True)
+    media_width: Mapped[int] = mapped_column(Integer(), nullable=True)
+    media_height: Mapped[int] = mapped_column(Integer(), nullable=True)
+    media_variants: Mapped[dict] = mapped_column(JSON(), nullable=True)
 
     user: Mapped["User"] = relationship(back_populates="posts")
     comments: Mapped[list["Comment"]] = relationship(back_populates="post")
@@ -141,6 +166,10 @@ class Post(db.Model):
             "id": self.id,
             "description": self.description,
             "media_url": self.media_url,
+            # thumbnails urls by size name, empty until the media is processed
+            "media_variants": self.media_variants or {},
+            "media_width": self.media_width,
+            "media_height": self.media_height,
             "status": self.status.name,
             "created_at": self.created_at.isoformat(),
             "user_id": self.user_id,
@@ -177,3 +206,43 @@ class Comment(db.Model):
             "user_id": self.user_id,
             "user": self.user.username,
         }
+
+
+# Events written in the same commit as the change that caused them (transactional outbox)
+# the outbox worker reads them later and runs the side effects out of the request
+class OutboxEvent(db.Model):
+    __tablename__ = 'outbox_event'
+    # the worker looks for earlier pending events of the same entity on every batch
+    __table_args__ = (db.Index('ix_outbox_event_entity', 'entity_type', 'entity_id', 'id'),)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    # the entity the event is about, events of the same entity are processed in order
+    entity_type: Mapped[str] = mapped_column(String(40), nullable=False)
+    entity_id: Mapped[int] = mapped_column(Integer(), nullable=False)
+    event_type: Mapped[str] = mapped_column(String(60), nullable=False)
+    payload: Mapped[dict] = mapped_column(JSON(), nullable=False, default=dict)
+    created_at: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True), default=datetime.datetime.now)
+    # retries: the event is not picked again before available_at
+    attempts: Mapped[int] = mapped_column(Integer(), nullable=False, default=0)
+    available_at: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True), default=datetime.datetime.now)
+    last_error: Mapped[str] = mapped_column(Text(), nullable=True)
+    processed_at: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True), nullable=True, index=True)
+
+    def __repr__(self):
+        return f"OutboxEvent(id={self.id}, event_type={self.event_type})"
+
+    def serialize(self):
+        return {
+            "id": self.id,
+            "entity_type": self.entity_type,
+            "entity_id": self.entity_id,
+            "event_type": self.event_type,
+            "payload": self.payload,
+            "created_at": self.created_at.isoformat(),
+            "attempts": self.attempts,
+            "last_error": self.last_error,
+            "processed_at": self.processed_at.isoformat() if self.processed_at else None,
+        }
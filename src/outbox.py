@@ -0,0 +1,185 @@
+import time
+import datetime
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select, exists, update, delete
+from models import db, OutboxEvent
+from sharding import shards
+import sharding
+
+
+# Side effects of the endpoints (counters, feed fan-out, search indexing, notifications...)
+# are not run inside the request. The endpoint calls add_event before its commit, so the
+# event is saved only if the change is saved, and the worker runs the handlers later.
+# With sharding the events of posts, comments and likes are saved in the outbox of their shard
+# (see sharding.py), the worker reads the main outbox and the outbox of every shard.
+#
+# Registering a handler:
+#
+#     @handler('post.created')
+#     def index_post(event):
+#         ...
+#
+# event is a dict with entity_type, entity_id, event_type and payload.
+# A handler that raises is retried later, with backoff, up to max_attempts times.
+# Processed events are deleted after purge_older_than days, failed ones are kept.
+
+HANDLERS = {}
+
+
+def handler(event_type):
+    def decorator(function):
+        HANDLERS.setdefault(event_type, []).append(function)
+        return function
+    return decorator
+
+
+def add_event(entity_type, entity_id, event_type, payload=None):
+    """
+    Add an event to the current session, it is saved with the next commit
+    """
+    event = OutboxEvent(
+        entity_type=entity_type,
+        entity_id=entity_id,
+        event_type=event_type,
+        payload=payload or {},
+    )
+    db.session.add(event)
+    return event
+
+
+class OutboxWorker:
+
+    # how often run_forever deletes the old processed events, in seconds
+    PURGE_INTERVAL = 3600
+
+    def __init__(self, app, batch_size=100, max_workers=4, max_attempts=5, poll_interval=1.0,
+                 purge_older_than=None):
+        self.app = app
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.purge_older_than = purge_older_than
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def run_forever(self):
+        purged_at = 0
+        while True:
+            if self.purge_older_than is not None and time.time() - purged_at > self.PURGE_INTERVAL:
+                self.purge(self.purge_older_than)
+                purged_at = time.time()
+            if not self.run_once():
+                time.sleep(self.poll_interval)
+
+    def outboxes(self):
+        # (engine, table) of the main outbox and of the outbox of every shard
+        result = [(db.engine, OutboxEvent.__table__)]
+        if shards.enabled:
+            result += [(engine, sharding.outbox) for engine in shards.engines]
+        return result
+
+    def purge(self, older_than):
+        """
+        Delete the events processed more than older_than days ago, returns how many were deleted
+        """
+        with self.app.app_context():
+            before = datetime.datetime.now() - datetime.timedelta(days=older_than)
+            deleted = 0
+            for engine, table in self.outboxes():
+                with engine.begin() as connection:
+                    deleted += connection.execute(delete(table).where(
+                        table.c.processed_at.is_not(None), table.c.processed_at < before)).rowcount
+            return deleted
+
+    def run_once(self):
+        """
+        Process one batch of events of every outbox, returns how many events were handled
+        """
+        with self.app.app_context():
+            return sum(self.run_batch(engine, table) for engine, table in self.outboxes())
+
+    def run_batch(self, engine, table):
+        now = datetime.datetime.now()
+        earlier = table.alias('earlier')
+        with engine.begin() as connection:
+            events = connection.execute(
+                select(table)
+                .where(table.c.processed_at.is_(None), table.c.attempts < self.max_attempts,
+                       table.c.available_at <= now)
+                # only the oldest pending event of each entity, so the events of an entity
+                # run in order and one waiting for a retry holds back the ones after it
+                .where(~exists().where(
+                    earlier.c.entity_type == table.c.entity_type,
+                    earlier.c.entity_id == table.c.entity_id,
+                    earlier.c.id < table.c.id,
+                    earlier.c.processed_at.is_(None),
+                    earlier.c.attempts < self.max_attempts))
+                .order_by(table.c.id)
+                .limit(self.batch_size)
+                # several workers can run at the same time on databases that support it
+                .with_for_update(skip_locked=True)
+            ).mappings().all()
+
+            handled = 0
+            jobs = [self.to_dict(event) for event in events]
+            for event, error in zip(events, self.executor.map(self.process_event, jobs)):
+                if error is None:
+                    values = {"processed_at": datetime.datetime.now()}
+                    handled += 1
+                else:
+                    values = {
+                        "attempts": event["attempts"] + 1,
+                        "last_error": error,
+                        "available_at": datetime.datetime.now() +
+                        datetime.timedelta(seconds=2 ** (event["attempts"] + 1)),
+                    }
+                connection.execute(update(table).where(table.c.id == event["id"]).values(**values))
+            return handled
+
+    def process_event(self, event):
+        # runs in a thread of the pool, with its own app context and database session
+        # returns the error, or None when all the handlers succeeded
+        with self.app.app_context():
+            try:
+                for function in HANDLERS.get(event["event_type"], []):
+                    function(event)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                return traceback.format_exc(limit=5)
+        return None
+
+    def to_dict(self, event):
+        return {
+            "id": event["id"],
+            "entity_type": event["entity_type"],
+            "entity_id": event["entity_id"],
+            "event_type": event["event_type"],
+            "payload": event["payload"],
+        }
+
+
+@click.command('outbox-worker')
+@click.option('--batch-size', default=100, help='Events read on each batch')
+@click.option('--workers', default=4, help='Threads running the handlers')
+@click.option('--max-attempts', default=5, help='Attempts before an event is left as failed')
+@click.option('--once', is_flag=True, help='Process a single batch and exit')
+@click.option('--purge-older-than', default=None, type=click.IntRange(min=0),
+              help='Delete the events processed more than this number of days ago')
+@with_appcontext
+def outbox_worker(batch_size, workers, max_attempts, once, purge_older_than):
+    """
+    Run the handlers of the events saved in the outbox
+    """
+    worker = OutboxWorker(current_app._get_current_object(), batch_size=batch_size,
+                          max_workers=workers, max_attempts=max_attempts,
+                          purge_older_than=purge_older_than)
+    if once:
+        if purge_older_than is not None:
+            click.echo(f"{worker.purge(purge_older_than)} processed events deleted")
+        click.echo(f"{worker.run_once()} events processed")
+    else:
+        worker.run_forever()
@@ -0,0 +1,240 @@
+import math
+import time
+import threading
+from flask import request, jsonify, current_app
+from sqlalchemy import select, insert, update, delete
+from sqlalchemy.exc import IntegrityError
+from models import db, rate_limit_buckets
+
+
+# Rate limiting and admission control for the API
+# Every request takes tokens from two buckets: one for the client and one for the endpoint.
+# When any of them is empty, or the request waited too long in the server queue,
+# the request is rejected with a 429 and a Retry-After header before touching the database.
+#
+# RATELIMIT_STORAGE chooses where the buckets are kept:
+#   "memory"   each process has its own buckets, fine for one process or for local development
+#   "database" a table of the main database shared by all the gunicorn workers and instances
+
+
+def refill(tokens, updated_at, rate, capacity, now):
+    # tokens of a bucket after refilling it at rate tokens per second since updated_at
+    return min(capacity, tokens + (now - updated_at) * rate)
+
+
+def take_levels(levels, cost):
+    # levels is a list of (key, rate, capacity, tokens), returns the seconds to wait
+    # and how many tokens to take from each bucket: all of cost, or none if any bucket is short
+    wait = max((cost - tokens) / rate for _, rate, _, tokens in levels)
+    return max(wait, 0), cost if wait <= 0 else 0
+
+
+class MemoryStorage:
+    """
+    Token buckets stored in the memory of the current process.
+    Every gunicorn worker has its own buckets, use DatabaseStorage to share them.
+    """
+
+    # how often the buckets that are full again are removed, in seconds
+    SWEEP_INTERVAL = 60
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.swept_at = 0
+
+    def take(self, buckets, cost, now):
+        """
+        Take cost tokens from every bucket, a list of (key, rate, capacity).
+        Tokens are only taken when all the buckets have enough of them,
+        returns how many seconds to wait (0 if allowed)
+        """
+        with self.lock:
+            if now - self.swept_at > self.SWEEP_INTERVAL:
+                self.sweep(now)
+            levels = []
+            for key, rate, capacity in buckets:
+                tokens, updated_at, _, _ = self.buckets.get(key, (capacity, now, rate, capacity))
+                levels.append((key, rate, capacity, refill(tokens, updated_at, rate, capacity, now)))
+            wait, taken = take_levels(levels, cost)
+            for key, rate, capacity, tokens in levels:
+                self.buckets[key] = (tokens - taken, now, rate, capacity)
+            return wait
+
+    def sweep(self, now):
+        # a bucket that refilled completely is the same as a new one, so it can be dropped
+        self.buckets = {
+            key: bucket for key, bucket in self.buckets.items()
+            if bucket[0] + (now - bucket[1]) * bucket[2] < bucket[3]
+        }
+        self.swept_at = now
+
+    def reset(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+class DatabaseStorage:
+    """
+    Token buckets stored in the rate_limit_bucket table of the main database,
+    so the limits are the same with any number of workers or instances.
+    The rows are locked while the tokens are taken (SELECT ... FOR UPDATE on postgres and mysql).
+    """
+
+    SWEEP_INTERVAL = 60
+
+    def __init__(self):
+        self.swept_at = 0
+
+    def take(self, buckets, cost, now):
+        """
+        Same as MemoryStorage.take
+        """
+        try:
+            return self._take(buckets, cost, now)
+        except IntegrityError:
+            # another worker created one of the buckets at the same time, now it exists
+            return self._take(buckets, cost, now)
+
+    def _take(self, buckets, cost, now):
+        table = rate_limit_buckets
+        # its own connection, so the limiter never commits the session of the request
+        with db.engine.begin() as connection:
+            if now - self.swept_at > self.SWEEP_INTERVAL:
+                self.sweep(connection, now)
+            # always locked in the same order, so two requests can not deadlock
+            rows = {row.key: row for row in connection.execute(
+                select(table).where(table.c.key.in_([key for key, _, _ in buckets]))
+                .order_by(table.c.key).with_for_update())}
+            levels = []
+            for key, rate, capacity in buckets:
+                row = rows.get(key)
+                tokens = refill(row.tokens, row.updated_at, rate, capacity, now) if row else capacity
+                levels.append((key, rate, capacity, tokens))
+            wait, taken = take_levels(levels, cost)
+            for key, rate, capacity, tokens in levels:
+                values = {"tokens": tokens - taken, "updated_at": now,
+                          "rate": rate, "capacity": capacity}
+                if key in rows:
+                    connection.execute(update(table).where(table.c.key == key).values(**values))
+                else:
+                    connection.execute(insert(table).values(key=key, **values))
+            return wait
+
+    def sweep(self, connection, now):
+        table = rate_limit_buckets
+        connection.execute(delete(table).where(
+            table.c.tokens + (now - table.c.updated_at) * table.c.rate >= table.c.capacity))
+        self.swept_at = now
+
+    def reset(self):
+        with db.engine.begin() as connection:
+            connection.execute(delete(rate_limit_buckets))
+
+
+STORAGES = {"memory": MemoryStorage, "database": DatabaseStorage}
+
+
+class RateLimiter:
+
+    def __init__(self, app=None, storage=None):
+        # a storage given here is used by every app, otherwise RATELIMIT_STORAGE chooses it
+        self.storage = storage
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RATELIMIT_ENABLED', True)
+        app.config.setdefault('RATELIMIT_STORAGE', 'memory')
+        # tokens per second and bucket size for each client
+        app.config.setdefault('RATELIMIT_CLIENT_RATE', 10)
+        app.config.setdefault('RATELIMIT_CLIENT_BURST', 40)
+        # tokens per second and bucket size for each endpoint, shared by all clients
+        app.config.setdefault('RATELIMIT_ENDPOINT_RATE', 100)
+        app.config.setdefault('RATELIMIT_ENDPOINT_BURST', 200)
+        # shed requests that waited longer than this in the proxy/gunicorn queue
+        app.config.setdefault('RATELIMIT_MAX_QUEUE_MS', 2000)
+        storage = self.storage
+        if storage is None:
+            if app.config['RATELIMIT_STORAGE'] not in STORAGES:
+                raise ValueError(f"RATELIMIT_STORAGE must be one of {', '.join(STORAGES)}")
+            storage = STORAGES[app.config['RATELIMIT_STORAGE']]()
+        app.extensions['ratelimit_storage'] = storage
+        app.before_request(self.check_request)
+
+    def cost(self, tokens):
+        """
+        Decorator to set how many tokens a route takes, expensive routes should take more
+        """
+        def decorator(view):
+            view.ratelimit_cost = tokens
+            return view
+        return decorator
+
+    def exempt(self, view):
+        """
+        Decorator for routes that are never limited, like the static media files
+        """
+        view.ratelimit_exempt = True
+        return view
+
+    def check_request(self):
+        config = current_app.config
+        if not config['RATELIMIT_ENABLED'] or request.endpoint is None:
+            return None
+        view = current_app.view_functions.get(request.endpoint)
+        if getattr(view, 'ratelimit_exempt', False):
+            return None
+
+        now = time.time()
+        queue_ms = self.queue_latency(now)
+        if queue_ms is not None and queue_ms > config['RATELIMIT_MAX_QUEUE_MS']:
+            return self.reject("Server is overloaded", 1)
+
+        cost = getattr(view, 'ratelimit_cost', 1)
+        buckets = [
+            ("client:" + self.client_id(), config['RATELIMIT_CLIENT_RATE'],
+             config['RATELIMIT_CLIENT_BURST']),
+            ("endpoint:" + request.endpoint, config['RATELIMIT_ENDPOINT_RATE'],
+             config['RATELIMIT_ENDPOINT_BURST']),
+        ]
+        wait = current_app.extensions['ratelimit_storage'].take(buckets, cost, now)
+        if wait:
+            return self.reject("Too many requests", wait)
+        return None
+
+    def client_id(self):
+        # X-Forwarded-For is not read here because any client can send it,
+        # behind a proxy set PROXY_HOPS so ProxyFix puts the real address in remote_addr
+        return request.remote_addr or 'unknown'
+
+    def queue_latency(self, now):
+        # X-Request-Start is set by the proxy when the request arrived, e.g. "t=1700000000123"
+        header = request.headers.get('X-Request-Start')
+        if not header:
+            return None
+        try:
+            started = float(header.replace('t=', ''))
+        except ValueError:
+            return None
+        if not math.isfinite(started):
+            return None
+        # the value can be in seconds, milliseconds or microseconds
+        if started > now * 100000:
+            started /= 1000000
+        elif started > now * 100:
+            started /= 1000
+        # anything more than an hour away is a wrong clock or a made up header
+        if abs(now - started) > 3600:
+            return None
+        return (now - started) * 1000
+
+    def reject(self, message, wait):
+        response = jsonify({"message": message})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(max(1, math.ceil(wait)))
+        return response
+
+
+# the limiter is created here and bound to the app in create_app, the same way as db
+limiter = RateLimiter()
@@ -0,0 +1,615 @@
+"""
+This module has all the endpoints of the API
+"""
+from flask import Blueprint, request, jsonify, current_app, send_from_directory
+from utils import APIException, generate_sitemap, cached_response, status_code, request_body, parse_id
+from models import db, User, Post, Comment
+from stats import get_users_stats, MAX_BATCH_USERS, MAX_DAYS
+from ratelimit import limiter
+from outbox import add_event
+from media import validate_media_url, save_media
+from sharding import shards
+import sharding
+
+api = Blueprint('api', __name__)
+
+# Handle/serialize errors like a JSON object
+
+
+@api.app_errorhandler(APIException)
+def handle_invalid_usage(error):
+    return jsonify(error.to_dict()), error.status_code
+
+# generate sitemap with all your endpoints
+
+
+@api.route('/')
+def sitemap():
+    """
+    List of all the endpoints
+    """
+    # the sitemap only changes when the app restarts, so it is built once and cached
+    return cached_response(current_app, 'sitemap', lambda: generate_sitemap(current_app), 'text/html')
+
+
+@api.route('/users', methods=['GET'])
+@limiter.cost(5)
+def get_users():
+    """
+    Get all users
+    """
+    users = User.query.all()
+    return jsonify([user.serialize() for user in users]), 200
+
+
+@api.route('/users/<int:user_id>', methods=['GET'])
+def get_user(user_id):
+    """
+    Get a user by id
+    """
+    user = User.query.get(user_id)
+    if user is None:
+        return jsonify({"message": "User not found"}), 404
+    return jsonify(user.serialize()), 200
+
+
+@api.route('/users', methods=['POST'])
+@status_code(201)
+@request_body({"username": "string", "password": "string", "email": "string", "birth_date": "date"},
+              required=["username", "password", "email", "birth_date"])
+def create_user():
+    """
+    Create a user
+    """
+    body = request.get_json()
+    if not body:
+        return jsonify({"message": "No body provided"}), 400
+    if 'username' not in body:
+        return jsonify({"message": "No username provided"}), 400
+    if 'password' not in body:
+        return jsonify({"message": "No password provided"}), 400
+    if 'email' not in body:
+        return jsonify({"message": "No email provided"}), 400
+    if 'birth_date' not in body:
+        return jsonify({"message": "No birth_date provided"}), 400
+
+    user = User(
+        username=body['username'],
+        password=body['password'],
+        email=body['email'],
+        birth_date=body['birth_date']
+    )
+    db.session.add(user)
+    db.session.commit()
+    return jsonify(user.serialize()), 201
+
+
+@api.route('/users/<int:user_id>', methods=['PUT'])
+@request_body({"username": "string", "password": "string", "email": "string", "birth_date": "date",
+               "is_verified": "boolean", "updated_at": "date-time"})
+def update_user(user_id):
+    """
+    Update a user
+    """
+    body = request.get_json()
+    if not body:
+        return jsonify({"message": "No body provided"}), 400
+    user = User.query.get(user_id)
+    if user is None:
+        return jsonify({"message": "User not found"}), 404
+
+    if 'username' in body:
+        user.username = body['username']
+    if 'password' in body:
+        user.password = body['password']
+    if 'email' in body:
+        user.email = body['email']
+    if 'birth_date' in body:
+        user.birth_date = body['birth_date']
+    if 'is_verified' in body:
+        user.is_verified = body['is_verified']
+    if "updated_at" in body:
+        user.updated_at = body['updated_at']
+
+    db.session.commit()
+    return jsonify(user.serialize()), 200
+
+
+@api.route('/users/<int:user_id>', methods=['DELETE'])
+def delete_user(user_id):
+    """
+    Delete a user
+    """
+    user = User.query.get(user_id)
+    if user is None:
+        return jsonify({"message": "User not found"}), 404
+    db.session.delete(user)
+    db.session.commit()
+    return jsonify({"message": "User deleted"}), 200
+
+
+@api.route('/users/<int:user_id>/follow', methods=['POST'])
+@request_body({"follower_id": "integer"}, required=["follower_id"])
+def follow_user(user_id):
+    """
+    Follow a user
+    """
+    body = request.get_json()
+    if not body:
+        return jsonify({"message": "No body provided"}), 400
+    if 'follower_id' not in body:
+        return jsonify({"message": "No follower_id provided"}), 400
+
+    user = User.query.get(user_id)
+    if user is None:
+        return jsonify({"message": "User not found"}), 404
+
+    follower = User.query.get(body['follower_id'])
+    if follower is None:
+        return jsonify({"message": "Follower not found"}), 404
+
+    user.followers.append(follower)
+    add_event('user', user.id, 'user.followed', {"follower_id": follower.id})
+    db.session.commit()
+    return jsonify(user.serialize()), 200
+
+
+@api.route('/users/<int:user_id>/unfollow', methods=['POST'])
+@request_body({"follower_id": "integer"}, required=["follower_id"])
+def unfollow_user(user_id):
+    """
+    Unfollow a user
+    """
+    body = request.get_json()
+    if not body:
+        return jsonify({"message": "No body provided"}), 400
+    if 'follower_id' not in body:
+        return jsonify({"message": "No follower_id provided"}), 400
+
+    user = User.query.get(user_id)
+    if user is None:
+        return jsonify({"message": "User not found"}), 404
+
+    follower = User.query.get(body['follower_id'])
+    if follower is None:
+        return jsonify({"message": "Follower not found"}), 404
+
+    user.followers.remove(follower)
+    add_event('user', user.id, 'user.unfollowed', {"follower_id": follower.id})
+    db.session.commit()
+    return jsonify(user.serialize()), 200
+
+
+@api.route('/users/<int:user_id>/like', methods=['POST'])
+@request_body({"post_id": "integer"}, required=["post_id"])
+def like_post(user_id):
+    """
+    Like a post
+    """
+    body = request.get_json()
+    if not body:
+        return jsonify({"message": "No body provided"}), 400
+    if 'post_id' not in body:
+        return jsonify({"message": "No post_id provided"}), 400
+    post_id = parse_id(body['post_id'])
+    if post_id is None:
+        return jsonify({"message": "post_id must be an integer"}), 400
+
+    user = User.query.get(user_id)
+    if user is None:
+        return jsonify({"message": "User not found"}), 404
+
+    if shards.enabled:
+        # the like and its event are saved in the shard of the post
+        if not sharding.set_like(post_id, user.id, True):
+            return jsonify({"message": "Post not found"}), 404
+        return jsonify(user.serialize()), 200
+
+    post = Post.query.get(post_id)
+    if post is None:
+        return jsonify({"message": "Post not found"}), 404
+
+    user.likes.append(post)
+    add_event('post', post.id, 'post.liked', {"user_id": user.id})
+    db.session.commit()
+    return jsonify(user.serialize()), 200
+
+
+@api.route('/users/<int:user_id>/unlike', methods=['POST'])
+@request_body({"post_id": "integer"}, required=["post_id"])
+def unlike_post(user_id):
+    """
+    Unlike a post
+    """
+    body = request.get_json()
+    if not body:
+        return jsonify({"message": "No body provided"}), 400
+    if 'post_id' not in body:
+        return jsonify({"message": "No post_id provided"}), 400
+    post_id = parse_id(body['post_id'])
+    if post_id is None:
+        return jsonify({"message": "post_id must be an integer"}), 400
+
+    user = User.query.get(user_id)
+    if user is None:
+        return jsonify({"message": "User not found"}), 404
+
+    if shards.enabled:
+        if not sharding.set_like(post_id, user.id, False):
+            return jsonify({"message": "Post not found"}), 404
+        return jsonify(user.serialize()), 200
+
+    post = Post.query.get(post_id)
+    if post is None:
+        return jsonify({"message": "Post not found"}), 404
+
+    user.likes.remove(post)
+    add_event('post', post.id, 'post.unliked', {"user_id": user.id})
+    db.session.commit()
+    return jsonify(user.serialize()), 200
+
+
+@api.route('/users/<int:user_id>/stats', methods=['GET'])
+def get_user_stats(user_id):
+    """
+    Get the activity stats of a user
+    """
+    days = parse_id(request.args.get('days', '30'))
+    if days is None or days > MAX_DAYS:
+        return jsonify({"message": f"days must be an integer between 0 and {MAX_DAYS}"}), 400
+    stats = get_users_stats([user_id], days=days)
+    if user_id not in stats:
+        return jsonify({"message": "User not found"}), 404
+    return jsonify(stats[user_id]), 200
+
+
+@api.route('/users/stats:batch', methods=['POST'])
+@limiter.cost(5)
+@request_body({"user_ids": "integers", "days": "integer"}, required=["user_ids"])
+def get_users_stats_batch():
+    """
+    Get the activity stats of many users at once
+    """
+    body = request.get_json()
+    if not body:
+        return jsonify({"message": "No body provided"}), 400
+    if 'user_ids' not in body:
+        return jsonify({"message": "No user_ids provided"}), 400
+    if not isinstance(body['user_ids'], list):
+        return jsonify({"message": "user_ids must be a list"}), 400
+    # bool is a subclass of int, but true/false are not user ids
+    if not all(isinstance(user_id, int) and not isinstance(user_id, bool)
+               for user_id in body['user_ids']):
+        return jsonify({"message": "user_ids must be a list of integers"}), 400
+    if len(body['user_ids']) > MAX_BATCH_USERS:
+        return jsonify({"message": f"No more than {MAX_BATCH_USERS} user_ids allowed"}), 400
+    days = body.get('days', 30)
+    if not isinstance(days, int) or isinstance(days, bool) or not 0 <= days <= MAX_DAYS:
+        return jsonify({"message": f"days must be an integer between 0 and {MAX_DAYS}"}), 400
+
+    stats = get_users_stats(body['user_ids'], days=days)
+    return jsonify({
+        "stats": [stats[user_id] for user_id in sorted(stats)],
+        "not_found": [user_id for user_id in body['user_ids'] if user_id not in stats],
+    }), 200
+
+
+@api.route('/posts', methods=['GET'])
+@limiter.cost(5)
+def get_posts():
+    """
+    Get all posts
+    """
+    if shards.enabled:
+        return jsonify(sharding.list_posts()), 200
+    posts = Post.query.all()
+    return jsonify([post.serialize() for post in posts]), 200
+
+
+@api.route('/posts/<int:post_id>', methods=['GET'])
+def get_post(post_id):
+    """
+    Get a post by id
+    """
+    if shards.enabled:
+        post = sharding.get_post(post_id)
+        if post is None:
+            return jsonify({"message": "Post not found"}), 404
+        return jsonify(post), 200
+    post = Post.query.get(post_id)
+    if post is None:
+        return jsonify({"message": "Post not found"}), 404
+    return jsonify(post.serialize()), 200
+
+
+@api.route('/users/<int:user_id>/posts', methods=['GET'])
+def get_user_posts(user_id):
+    """
+    Get the posts of a user, newest first
+    """
+    user = User.query.get(user_id)
+    if user is None:
+        return jsonify({"message": "User not found"}), 404
+    if shards.enabled:
+        # all the posts of a user are in the same shard
+        return jsonify(sharding.list_posts(user_id)), 200
+    posts = Post.query.filter_by(user_id=user_id).order_by(
+        Post.created_at.desc(), Post.id.desc()).all()
+    return jsonify([post.serialize() for post in posts]), 200
+
+
+@api.route('/posts', methods=['POST'])
+@status_code(201)
+@request_body({"description": "string", "media_url": "string", "user_id": "integer"},
+              required=["description", "media_url", "user_id"])
+def create_post():
+    """
+    Create a post
+    """
+    body = request.get_json()
+    if not body:
+        return jsonify({"message": "No body provided"}), 400
+    if 'description' not in body:
+        return jsonify({"message": "No description provided"}), 400
+    if 'media_url' not in body:
+        return jsonify({"message": "No media_url provided"}), 400
+    if 'user_id' not in body:
+        return jsonify({"message": "No user_id provided"}), 400
+    user_id = parse_id(body['user_id'])
+    if user_id is None:
+        return jsonify({"message": "user_id must be an integer"}), 400
+    # the shards have no foreign keys, so the user is checked here
+    if db.session.get(User, user_id) is None:
+        return jsonify({"message": "User not found"}), 404
+    error = validate_media_url(body['media_url'])
+    if error is not None:
+        return jsonify({"message": error}), 400
+
+    if shards.enabled:
+        post = sharding.create_post(body['description'], body['media_url'], user_id)
+        return jsonify(post), 201
+
+    post = Post(
+        description=body['description'],
+        media_url=body['media_url'],
+        user_id=user_id
+    )
+    db.session.add(post)
+    # flush to get the id of the post, the event is saved in the same commit
+    db.session.flush()
+    add_event('post', post.id, 'post.created', {"user_id": post.user_id})
+    db.session.commit()
+    return jsonify(post.serialize()), 201
+
+
+@api.route('/posts/<int:post_id>', methods=['PUT'])
+@request_body({"description": "string", "media_url": "string", "status": "string",
+               "user_id": "integer"})
+def update_post(post_id):
+    """
+    Update a post
+    """
+    body = request.get_json()
+    if not body:
+        return jsonify({"message": "No body provided"}), 400
+    if 'user_id' in body:
+        if parse_id(body['user_id']) is None:
+            return jsonify({"message": "user_id must be an integer"}), 400
+        if db.session.get(User, parse_id(body['user_id'])) is None:
+            return jsonify({"message": "User not found"}), 404
+    if shards.enabled:
+        return update_sharded_post(post_id, body)
+    post = Post.query.get(post_id)
+    if post is None:
+        return jsonify({"message": "Post not found"}), 404
+
+    if 'description' in body:
+        post.description = body['description']
+    if 'media_url' in body and body['media_url'] != post.media_url:
+        error = validate_media_url(body['media_url'])
+        if error is not None:
+            return jsonify({"message": error}), 400
+        post.media_url = body['media_url']
+        # the old thumbnails are not valid anymore, they are generated again for the new media
+        post.media_hash = post.media_width = post.media_height = post.media_variants = None
+        add_event('post', post.id, 'post.media_changed', {"user_id": post.user_id})
+    if 'status' in body:
+        post.status = body['status']
+    if 'user_id' in body:
+        post.user_id = parse_id(body['user_id'])
+
+    db.session.commit()
+    return jsonify(post.serialize()), 200
+
+
+def update_sharded_post(post_id, body):
+    current = sharding.get_post(post_id)
+    if current is None:
+        return jsonify({"message": "Post not found"}), 404
+    media_changed = 'media_url' in body and body['media_url'] != current['media_url']
+
+    values = {key: body[key] for key in ('description', 'status') if key in body}
+    if media_changed:
+        error = validate_media_url(body['media_url'])
+        if error is not None:
+            return jsonify({"message": error}), 400
+        values.update(media_url=body['media_url'], media_hash=None,
+                      media_width=None, media_height=None, media_variants=None)
+    if 'user_id' in body:
+        # the id of the post says in which shard it is, so it can not change of shard
+        user_id = parse_id(body['user_id'])
+        if shards.for_user(user_id) is not shards.for_id(post_id):
+            return jsonify({"message": "The post can not be moved to that user"}), 400
+        values['user_id'] = user_id
+
+    post = sharding.update_post(
+        post_id, values, event_type='post.media_changed' if media_changed else None)
+    if post is None:
+        return jsonify({"message": "Post not found"}), 404
+    return jsonify(post), 200
+
+
+@api.route('/media', methods=['POST'])
+@limiter.cost(5)
+@status_code(201)
+@request_body({"file": "file"}, required=["file"], content_type="multipart/form-data")
+def upload_media():
+    """
+    Upload an image, use the returned media_url to create a post
+    """
+    file = request.files.get('file')
+    if file is None:
+        return jsonify({"message": "No file provided"}), 400
+    media_url = save_media(file.read())
+    if media_url is None:
+        return jsonify({"message": "The file is not a supported image"}), 400
+    return jsonify({"media_url": media_url}), 201
+
+
+@api.route('/media/<path:filename>', methods=['GET'])
+@limiter.exempt
+def get_media(filename):
+    """
+    Get an uploaded image or one of its thumbnails
+    """
+    # files are named by the hash of their content so they never change
+    response = send_from_directory(
+        current_app.config['MEDIA_ROOT'], filename, max_age=31536000)
+    response.cache_control.public = True
+    return response
+
+
+@api.route('/posts/<int:post_id>', methods=['DELETE'])
+def delete_post(post_id):
+    """
+    Delete a post
+    """
+    if shards.enabled:
+        if not sharding.delete_post(post_id):
+            return jsonify({"message": "Post not found"}), 404
+        return jsonify({"message": "Post deleted"}), 200
+    post = Post.query.get(post_id)
+    if post is None:
+        return jsonify({"message": "Post not found"}), 404
+    db.session.delete(post)
+    add_event('post', post.id, 'post.deleted', {"user_id": post.user_id})
+    db.session.commit()
+    return jsonify({"message": "Post deleted"}), 200
+
+
+@api.route('/posts/<int:post_id>/comments', methods=['GET'])
+def get_comments(post_id):
+    """
+    Get all comments for a post
+    """
+    if shards.enabled:
+        comments = sharding.list_comments(post_id)
+        if comments is None:
+            return jsonify({"message": "Post not found"}), 404
+        return jsonify(comments), 200
+    post = Post.query.get(post_id)
+    if post is None:
+        return jsonify({"message": "Post not found"}), 404
+    return jsonify([comment.serialize() for comment in post.comments]), 200
+
+
+@api.route('/posts/<int:post_id>/comments', methods=['POST'])
+@status_code(201)
+@request_body({"text": "string", "user_id": "integer"}, required=["text", "user_id"])
+def create_comment(post_id):
+    """
+    Create a comment for a post
+    """
+    body = request.get_json()
+    if not body:
+        return jsonify({"message": "No body provided"}), 400
+    if 'text' not in body:
+        return jsonify({"message": "No text provided"}), 400
+    if 'user_id' not in body:
+        return jsonify({"message": "No user_id provided"}), 400
+    user_id = parse_id(body['user_id'])
+    if user_id is None:
+        return jsonify({"message": "user_id must be an integer"}), 400
+    if db.session.get(User, user_id) is None:
+        return jsonify({"message": "User not found"}), 404
+
+    if shards.enabled:
+        # the comment and its event are saved in the shard of the post
+        comment = sharding.create_comment(post_id, body['text'], user_id)
+        if comment is None:
+            return jsonify({"message": "Post not found"}), 404
+        return jsonify(comment), 201
+
+    post = Post.query.get(post_id)
+    if post is None:
+        return jsonify({"message": "Post not found"}), 404
+
+    comment = Comment(
+        text=body['text'],
+        user_id=user_id,
+        post_id=post_id
+    )
+    db.session.add(comment)
+    db.session.flush()
+    add_event('post', post_id, 'comment.created', {
+              "comment_id": comment.id, "user_id": comment.user_id})
+    db.session.commit()
+    return jsonify(comment.serialize()), 201
+
+
+@api.route('/posts/<int:post_id>/comments/<int:comment_id>', methods=['PUT'])
+@request_body({"text": "string", "user_id": "integer", "post_id": "integer"})
+def update_comment(post_id, comment_id):
+    """
+    Update a comment for a post
+    """
+    body = request.get_json()
+    if not body:
+        return jsonify({"message": "No body provided"}), 400
+    for key in ('user_id', 'post_id'):
+        if key in body and parse_id(body[key]) is None:
+            return jsonify({"message": f"{key} must be an integer"}), 400
+    if 'user_id' in body and db.session.get(User, parse_id(body['user_id'])) is None:
+        return jsonify({"message": "User not found"}), 404
+    if shards.enabled:
+        values = {key: body[key] for key in ('text',) if key in body}
+        values.update({key: parse_id(body[key]) for key in ('user_id', 'post_id') if key in body})
+        # comments are saved with their post, they can only move to a post of the same shard
+        if 'post_id' in values and shards.for_id(values['post_id']) is not shards.for_id(comment_id):
+            return jsonify({"message": "The comment can not be moved to that post"}), 400
+        comment = sharding.update_comment(comment_id, values)
+        if comment is None:
+            return jsonify({"message": "Comment not found"}), 404
+        return jsonify(comment), 200
+    comment = Comment.query.get(comment_id)
+    if comment is None:
+        return jsonify({"message": "Comment not found"}), 404
+
+    if 'text' in body:
+        comment.text = body['text']
+    if 'user_id' in body:
+        comment.user_id = parse_id(body['user_id'])
+    if 'post_id' in body:
+        comment.post_id = parse_id(body['post_id'])
+
+    db.session.commit()
+    return jsonify(comment.serialize()), 200
+
+
+@api.route('/posts/<int:post_id>/comments/<int:comment_id>', methods=['DELETE'])
+def delete_comment(post_id, comment_id):
+    """
+    Delete a comment for a post
+    """
+    if shards.enabled:
+        if sharding.delete_comment(comment_id) is None:
+            return jsonify({"message": "Comment not found"}), 404
+        return jsonify({"message": "Comment deleted"}), 200
+    comment = Comment.query.get(comment_id)
+    if comment is None:
+        return jsonify({"message": "Comment not found"}), 404
+    db.session.delete(comment)
+    add_event('post', comment.post_id, 'comment.deleted', {
+              "comment_id": comment.id, "user_id": comment.user_id})
+    db.session.commit()
+    return jsonify({"message": "Comment deleted"}), 200
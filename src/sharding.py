@@ -0,0 +1,402 @@
+import heapq
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import (create_engine, MetaData, Table, Column, Index, select, insert, update,
+                        delete, text)
+from models import db, User, Post, Comment, OutboxEvent, PostStatus, likes
+from utils import APIException
+
+
+# Sharding of posts, comments and likes
+# When SHARD_DATABASE_URLS has a list of databases, the posts are saved in the shard of
+# their owner (user_id % number of shards). The comments and likes of a post are saved in the
+# same shard as the post, so reading a post with its comments and likes uses one database.
+# Users and followers stay in the main database (SQLALCHEMY_DATABASE_URI).
+# Every shard has its own outbox: the events of a change are saved in the same transaction
+# as the change, and the outbox worker reads the outbox of every shard.
+#
+# The ids of each shard start at index * ID_RANGE, so the id of a post or a comment
+# tells in which shard it is. Run `flask shards-init` to create the tables and the id ranges.
+#
+# Listings of all the posts query every shard in parallel and merge them by created_at.
+
+# with 32 bit ids this allows up to 21 shards of 100 million rows each
+ID_RANGE = 100_000_000
+
+shard_metadata = MetaData()
+
+
+def _copy_table(table, **kwargs):
+    # same columns without the foreign keys, the users are in another database
+    return Table(table.name, shard_metadata, *[
+        Column(column.name, column.type, primary_key=column.primary_key,
+               nullable=column.nullable,
+               index=column.index or column.name in ('user_id', 'post_id', 'created_at'))
+        for column in table.columns
+    ], **kwargs)
+
+
+posts = _copy_table(Post.__table__, sqlite_autoincrement=True)
+comments = _copy_table(Comment.__table__, sqlite_autoincrement=True)
+shard_likes = _copy_table(likes)
+outbox = _copy_table(OutboxEvent.__table__, sqlite_autoincrement=True)
+Index('ix_outbox_event_entity', outbox.c.entity_type, outbox.c.entity_id, outbox.c.id)
+
+
+class ShardRouter:
+
+    def __init__(self, app=None):
+        self.executor = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SHARD_DATABASE_URLS', [])
+        app.extensions['shard_engines'] = [
+            create_engine(url.replace("postgres://", "postgresql://"))
+            for url in app.config['SHARD_DATABASE_URLS']
+        ]
+
+    @property
+    def enabled(self):
+        return bool(current_app.extensions.get('shard_engines'))
+
+    @property
+    def engines(self):
+        return current_app.extensions['shard_engines']
+
+    def for_user(self, user_id):
+        return self.engines[user_id % len(self.engines)]
+
+    def for_id(self, entity_id):
+        index = (entity_id - 1) // ID_RANGE
+        if entity_id < 1 or index >= len(self.engines):
+            return None
+        return self.engines[index]
+
+    def scatter(self, function):
+        """
+        Run function(connection) on every shard in parallel, returns the results in shard order
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=8)
+
+        def run(engine):
+            with engine.connect() as connection:
+                return function(connection)
+        return list(self.executor.map(run, self.engines))
+
+    def init_shards(self):
+        for index, engine in enumerate(self.engines):
+            shard_metadata.create_all(engine)
+            start = index * ID_RANGE
+            with engine.begin() as connection:
+                for table in (posts, comments):
+                    _set_first_id(connection, table.name, start)
+
+
+def _set_first_id(connection, table_name, start):
+    # the next id of the table will be start + 1, unless the table already has bigger ids
+    dialect = connection.dialect.name
+    if start == 0:
+        return
+    if dialect == 'sqlite':
+        connection.execute(text(
+            "INSERT INTO sqlite_sequence (name, seq) SELECT :name, :start "
+            "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = :name)"),
+            {"name": table_name, "start": start})
+    elif dialect == 'postgresql':
+        connection.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table_name}', 'id'), "
+            f"GREATEST(:start, (SELECT COALESCE(MAX(id), 0) FROM {table_name})))"),
+            {"start": start})
+    elif dialect in ('mysql', 'mariadb'):
+        connection.execute(text(f"ALTER TABLE {table_name} AUTO_INCREMENT = {start + 1}"))
+    else:
+        raise click.ClickException(f"Sharding is not supported for {dialect}")
+
+
+shards = ShardRouter()
+
+
+###########################
+# posts
+###########################
+
+def _usernames(user_ids):
+    rows = db.session.execute(
+        select(User.id, User.username).where(User.id.in_(set(user_ids)))).all()
+    return dict(rows)
+
+
+def _load_posts(connection, stmt):
+    # posts with the texts of their comments and the ids of the users that liked them
+    rows = connection.execute(stmt).mappings().all()
+    post_ids = [row["id"] for row in rows]
+    post_comments = {post_id: [] for post_id in post_ids}
+    post_likes = {post_id: [] for post_id in post_ids}
+    if post_ids:
+        for post_id, comment_text in connection.execute(
+                select(comments.c.post_id, comments.c.text)
+                .where(comments.c.post_id.in_(post_ids)).order_by(comments.c.id)):
+            post_comments[post_id].append(comment_text)
+        for post_id, user_id in connection.execute(
+                select(shard_likes.c.post_id, shard_likes.c.user_id)
+                .where(shard_likes.c.post_id.in_(post_ids))):
+            post_likes[post_id].append(user_id)
+    return [(dict(row), post_comments[row["id"]], post_likes[row["id"]]) for row in rows]
+
+
+def _serialize_posts(loaded):
+    # same output as Post.serialize
+    user_ids = [row["user_id"] for row, _, _ in loaded]
+    user_ids += [user_id for _, _, liked_by in loaded for user_id in liked_by]
+    usernames = _usernames(user_ids)
+    return [{
+        "id": row["id"],
+        "description": row["description"],
+        "media_url": row["media_url"],
+        "media_variants": row["media_variants"] or {},
+        "media_width": row["media_width"],
+        "media_height": row["media_height"],
+        "status": row["status"].name,
+        "created_at": row["created_at"].isoformat(),
+        "user_id": row["user_id"],
+        "user": usernames.get(row["user_id"]),
+        "comments": post_comments,
+        "liked_by": [usernames.get(user_id) for user_id in liked_by],
+        "likes_count": len(liked_by),
+        "comments_count": len(post_comments),
+    } for row, post_comments, liked_by in loaded]
+
+
+def list_posts(user_id=None):
+    """
+    Posts of a user (one shard) or of everybody (all the shards), newest first
+    """
+    stmt = select(posts).order_by(posts.c.created_at.desc(), posts.c.id.desc())
+    if user_id is not None:
+        with shards.for_user(user_id).connect() as connection:
+            return _serialize_posts(_load_posts(connection, stmt.where(posts.c.user_id == user_id)))
+
+    # every shard returns its posts already sorted, so they only need to be merged
+    results = shards.scatter(lambda connection: _load_posts(connection, stmt))
+    merged = heapq.merge(*results, key=lambda loaded: loaded[0]["created_at"], reverse=True)
+    return _serialize_posts(list(merged))
+
+
+def list_post_ids(user_id):
+    """
+    Ids of the posts of a user, they are all in the shard of the user
+    """
+    with shards.for_user(user_id).connect() as connection:
+        return list(connection.execute(
+            select(posts.c.id).where(posts.c.user_id == user_id).order_by(posts.c.id)).scalars())
+
+
+def get_post(post_id):
+    engine = shards.for_id(post_id)
+    if engine is None:
+        return None
+    with engine.connect() as connection:
+        loaded = _load_posts(connection, select(posts).where(posts.c.id == post_id))
+    return _serialize_posts(loaded)[0] if loaded else None
+
+
+def _check_id_range(engine, entity_id):
+    # raising inside engine.begin() rolls back the insert, so no row is left in the wrong range
+    if shards.for_id(entity_id) is not engine:
+        raise APIException(
+            "The shard is not initialized for its id range, run `flask shards-init`", 500)
+
+
+def _add_event(connection, entity_type, entity_id, event_type, payload=None):
+    # same as outbox.add_event, in the outbox of the shard and the transaction of the change
+    now = datetime.datetime.now()
+    connection.execute(insert(outbox).values(
+        entity_type=entity_type,
+        entity_id=entity_id,
+        event_type=event_type,
+        payload=payload or {},
+        created_at=now,
+        attempts=0,
+        available_at=now,
+    ))
+
+
+def create_post(description, media_url, user_id):
+    engine = shards.for_user(user_id)
+    with engine.begin() as connection:
+        post_id = connection.execute(insert(posts).values(
+            description=description,
+            media_url=media_url,
+            user_id=user_id,
+            status=PostStatus.APPROVED,
+            created_at=datetime.datetime.now(),
+        )).inserted_primary_key[0]
+        _check_id_range(engine, post_id)
+        _add_event(connection, 'post', post_id, 'post.created', {"user_id": user_id})
+    return get_post(post_id)
+
+
+def update_post(post_id, values, event_type=None):
+    """
+    Returns the updated post, None if it does not exist.
+    When event_type is given the event is saved with the change
+    """
+    engine = shards.for_id(post_id)
+    if engine is None:
+        return None
+    with engine.begin() as connection:
+        user_id = connection.execute(
+            select(posts.c.user_id).where(posts.c.id == post_id)).scalar()
+        if user_id is None:
+            return None
+        if values:
+            connection.execute(update(posts).where(posts.c.id == post_id).values(**values))
+        if event_type is not None:
+            _add_event(connection, 'post', post_id, event_type,
+                       {"user_id": values.get('user_id', user_id)})
+    return get_post(post_id)
+
+
+def delete_post(post_id):
+    """
+    Delete a post with its comments and likes, returns False if it does not exist
+    """
+    engine = shards.for_id(post_id)
+    if engine is None:
+        return False
+    with engine.begin() as connection:
+        user_id = connection.execute(
+            select(posts.c.user_id).where(posts.c.id == post_id)).scalar()
+        if user_id is None:
+            return False
+        connection.execute(delete(comments).where(comments.c.post_id == post_id))
+        connection.execute(delete(shard_likes).where(shard_likes.c.post_id == post_id))
+        connection.execute(delete(posts).where(posts.c.id == post_id))
+        _add_event(connection, 'post', post_id, 'post.deleted', {"user_id": user_id})
+    return True
+
+
+def set_like(post_id, user_id, liked):
+    """
+    Like or unlike a post, returns False if the post does not exist
+    """
+    engine = shards.for_id(post_id)
+    if engine is None:
+        return False
+    with engine.begin() as connection:
+        if connection.execute(select(posts.c.id).where(posts.c.id == post_id)).first() is None:
+            return False
+        connection.execute(delete(shard_likes).where(
+            shard_likes.c.post_id == post_id, shard_likes.c.user_id == user_id))
+        if liked:
+            connection.execute(insert(shard_likes).values(
+                post_id=post_id, user_id=user_id, created_at=datetime.datetime.now()))
+        _add_event(connection, 'post', post_id, 'post.liked' if liked else 'post.unliked',
+                   {"user_id": user_id})
+    return True
+
+
+###########################
+# comments
+###########################
+
+def _serialize_comments(rows):
+    # same output as Comment.serialize
+    usernames = _usernames([row["user_id"] for row in rows])
+    return [{
+        "id": row["id"],
+        "text": row["text"],
+        "created_at": row["created_at"].isoformat(),
+        "post_id": row["post_id"],
+        "user_id": row["user_id"],
+        "user": usernames.get(row["user_id"]),
+    } for row in rows]
+
+
+def list_comments(post_id):
+    """
+    Comments of a post, None if the post does not exist
+    """
+    engine = shards.for_id(post_id)
+    if engine is None:
+        return None
+    with engine.connect() as connection:
+        if connection.execute(select(posts.c.id).where(posts.c.id == post_id)).first() is None:
+            return None
+        rows = connection.execute(
+            select(comments).where(comments.c.post_id == post_id).order_by(comments.c.id)
+        ).mappings().all()
+    return _serialize_comments(rows)
+
+
+def create_comment(post_id, text, user_id):
+    """
+    Comment a post, saved in the shard of the post. None if the post does not exist
+    """
+    engine = shards.for_id(post_id)
+    if engine is None:
+        return None
+    with engine.begin() as connection:
+        if connection.execute(select(posts.c.id).where(posts.c.id == post_id)).first() is None:
+            return None
+        comment_id = connection.execute(insert(comments).values(
+            text=text, user_id=user_id, post_id=post_id, created_at=datetime.datetime.now(),
+        )).inserted_primary_key[0]
+        _check_id_range(engine, comment_id)
+        _add_event(connection, 'post', post_id, 'comment.created',
+                   {"comment_id": comment_id, "user_id": user_id})
+        row = connection.execute(
+            select(comments).where(comments.c.id == comment_id)).mappings().first()
+    return _serialize_comments([row])[0]
+
+
+def update_comment(comment_id, values):
+    """
+    Returns the updated comment, None if it does not exist
+    """
+    engine = shards.for_id(comment_id)
+    if engine is None:
+        return None
+    with engine.begin() as connection:
+        if values:
+            connection.execute(
+                update(comments).where(comments.c.id == comment_id).values(**values))
+        row = connection.execute(
+            select(comments).where(comments.c.id == comment_id)).mappings().first()
+    return _serialize_comments([row])[0] if row else None
+
+
+def delete_comment(comment_id):
+    """
+    Returns the deleted comment, None if it does not exist
+    """
+    engine = shards.for_id(comment_id)
+    if engine is None:
+        return None
+    with engine.begin() as connection:
+        row = connection.execute(
+            select(comments).where(comments.c.id == comment_id)).mappings().first()
+        if row is None:
+            return None
+        connection.execute(delete(comments).where(comments.c.id == comment_id))
+        _add_event(connection, 'post', row['post_id'], 'comment.deleted',
+                   {"comment_id": row['id'], "user_id": row['user_id']})
+    return dict(row)
+
+
+@click.command('shards-init')
+@with_appcontext
+def shards_init():
+    """
+    Create the tables and the id ranges in every database of SHARD_DATABASE_URLS
+    """
+    if not shards.enabled:
+        raise click.ClickException("SHARD_DATABASE_URLS is empty")
+    shards.init_shards()
+    click.echo(f"{len(shards.engines)} shards ready")
@@ -0,0 +1,92 @@
+import datetime
+from sqlalchemy import select, func
+from models import db, User, Post, Comment, likes, followers
+from sharding import shards
+
+
+# Aggregated activity numbers for one or more users.
+# Every metric is computed with a single grouped query for all the requested users,
+# so the cost does not grow with the number of posts, comments or likes each user has.
+
+
+def _execute(stmt, sharded=True):
+    # posts, comments and likes can be in several shards, then the rows of all of them are returned
+    if sharded and shards.enabled:
+        return [row for rows in shards.scatter(lambda connection: connection.execute(stmt).all())
+                for row in rows]
+    return db.session.execute(stmt).all()
+
+
+def _count_by_user(column, *joins, sharded=True):
+    # Returns {user_id: count} grouping by the given user_id column
+    def query(user_ids):
+        stmt = select(column, func.count()).select_from(column.table)
+        for target, onclause in joins:
+            stmt = stmt.join(target, onclause)
+        stmt = stmt.where(column.in_(user_ids)).group_by(column)
+        counts = {}
+        for user_id, count in _execute(stmt, sharded):
+            counts[user_id] = counts.get(user_id, 0) + count
+        return counts
+    return query
+
+
+def _activity_by_day(user_ids, since):
+    # Returns {user_id: {day: count}} adding up posts, comments and likes given per day
+    activity = {user_id: {} for user_id in user_ids}
+    sources = [
+        (Post.__table__.c.user_id, Post.__table__.c.created_at),
+        (Comment.__table__.c.user_id, Comment.__table__.c.created_at),
+        (likes.c.user_id, likes.c.created_at),
+    ]
+    for user_column, date_column in sources:
+        day = func.date(date_column)
+        stmt = (
+            select(user_column, day, func.count())
+            .where(user_column.in_(user_ids), date_column >= since)
+            .group_by(user_column, day)
+        )
+        for user_id, day_value, count in _execute(stmt):
+            key = str(day_value)
+            activity[user_id][key] = activity[user_id].get(key, 0) + count
+    return {user_id: dict(sorted(days.items())) for user_id, days in activity.items()}
+
+
+# In User.serialize the "followers" of a user come from the followed_by relationship,
+# which matches the follower_id column, so we count the same way to keep both endpoints consistent
+METRICS = {
+    "posts": _count_by_user(Post.__table__.c.user_id),
+    "likes_received": _count_by_user(
+        Post.__table__.c.user_id, (likes, likes.c.post_id == Post.__table__.c.id)),
+    "likes_given": _count_by_user(likes.c.user_id),
+    "comments": _count_by_user(Comment.__table__.c.user_id),
+    "followers": _count_by_user(followers.c.follower_id, sharded=False),
+    "following": _count_by_user(followers.c.followed_id, sharded=False),
+}
+
+
+# most users accepted by one call, it keeps the IN (...) of the queries small
+MAX_BATCH_USERS = 100
+# longest period of the activity_by_day, in days
+MAX_DAYS = 3650
+
+
+def get_users_stats(user_ids, days=30):
+    """
+    Get the stats of every existing user in user_ids, keyed by user id
+    """
+    user_ids = set(db.session.execute(
+        select(User.id).where(User.id.in_(user_ids))).scalars())
+    if not user_ids:
+        return {}
+
+    stats = {user_id: {"user_id": user_id} for user_id in user_ids}
+    for name, query in METRICS.items():
+        counts = query(user_ids)
+        for user_id in user_ids:
+            stats[user_id][name] = counts.get(user_id, 0)
+
+    since = datetime.datetime.now() - datetime.timedelta(days=days)
+    for user_id, activity in _activity_by_day(user_ids, since).items():
+        stats[user_id]["activity_by_day"] = activity
+    return stats
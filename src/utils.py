@@ -1,4 +1,8 @@
-from flask import jsonify, url_for
+import re
+import json
+import hashlib
+import inspect
+from flask import jsonify, url_for, request, Response
 
 class APIException(Exception):
     status_code = 400
@@ -15,13 +19,25 @@ class APIException(Exception):
         rv['message'] = self.message
         return rv
 
+def parse_id(value):
+    """
+    Id received in a json body as a number or a string of digits, None if it is not valid
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    return None
+
 def has_no_empty_params(rule):
     defaults = rule.defaults if rule.defaults is not None else ()
     arguments = rule.arguments if rule.arguments is not None else ()
     return len(defaults) >= len(arguments)
 
 def generate_sitemap(app):
-    links = ['/admin/']
+    links = ['/admin/'] if app.config.get('ENABLE_ADMIN') else []
     for rule in app.url_map.iter_rules():
         # Filter out rules we can't navigate to in a browser
         # and rules that require parameters
@@ -39,3 +55,111 @@ def generate_sitemap(app):
         <p>Start working on your proyect by following the <a href="https://start.4geeksacademy.com/starters/flask" target="_blank">Quick Start</a></p>
         <p>Remember to specify a real endpoint path like: </p>
         <ul style="text-align: left;">"""+links_html+"</ul></div>"
+
+
+def cached_response(app, key, build, mimetype):
+    """
+    Build the body only once per app and serve it with an ETag,
+    clients that send If-None-Match with the same ETag get an empty 304
+    """
+    cached = app.extensions.get(key)
+    if cached is None:
+        body = build()
+        cached = (body, hashlib.sha1(body.encode()).hexdigest())
+        app.extensions[key] = cached
+    body, etag = cached
+    response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 300
+    return response.make_conditional(request)
+
+def status_code(code):
+    """
+    Decorator to document the status code of a route when it is not 200, e.g. 201 for creates
+    """
+    def decorator(view):
+        view.openapi_status = code
+        return view
+    return decorator
+
+# OpenAPI schemas of the field types used in request_body
+FIELD_TYPES = {
+    "string": {"type": "string"},
+    "integer": {"type": "integer"},
+    "boolean": {"type": "boolean"},
+    "date": {"type": "string", "format": "date"},
+    "date-time": {"type": "string", "format": "date-time"},
+    "integers": {"type": "array", "items": {"type": "integer"}},
+    "file": {"type": "string", "format": "binary"},
+}
+
+def request_body(fields, required=(), content_type="application/json"):
+    """
+    Decorator to document the body of a route, fields maps each field name to a FIELD_TYPES key
+    """
+    def decorator(view):
+        schema = {
+            "type": "object",
+            "properties": {name: FIELD_TYPES[field_type] for name, field_type in fields.items()},
+        }
+        if required:
+            schema["required"] = list(required)
+        view.openapi_request_body = {"required": True, "content": {content_type: {"schema": schema}}}
+        return view
+    return decorator
+
+# OpenAPI types for the flask url converters
+CONVERTER_TYPES = {"int": "integer", "float": "number"}
+
+def responses(view, method, parameters):
+    success = getattr(view, 'openapi_status', 200)
+    result = {str(success): {"description": "Created" if success == 201 else "Success"}}
+    if method in ("POST", "PUT"):
+        result["400"] = {"description": "Missing or invalid fields in the body"}
+    if parameters:
+        result["404"] = {"description": "Not found"}
+    # every route goes through the rate limiter, except the exempt ones
+    if not getattr(view, 'ratelimit_exempt', False):
+        result["429"] = {"description": "Too many requests, see the Retry-After header"}
+    return result
+
+def generate_openapi(app):
+    paths = {}
+    for rule in sorted(app.url_map.iter_rules(), key=lambda rule: rule.rule):
+        # the admin and static files are not part of the API
+        if rule.endpoint == "static" or rule.rule.startswith("/admin"):
+            continue
+        params = re.findall(r"<(?:(\w+):)?(\w+)>", rule.rule)
+        path = re.sub(r"<(?:\w+:)?(\w+)>", r"{\1}", rule.rule)
+        parameters = [{
+            "name": name,
+            "in": "path",
+            "required": True,
+            "schema": {"type": CONVERTER_TYPES.get(converter, "string")},
+        } for converter, name in params]
+
+        view = app.view_functions[rule.endpoint]
+        doc = inspect.getdoc(view) or ""
+        methods = sorted(rule.methods - {"HEAD", "OPTIONS"})
+        for method in methods:
+            operation = {
+                "operationId": rule.endpoint if len(methods) == 1 else rule.endpoint + "_" + method.lower(),
+                "summary": doc.split("\n")[0],
+                "responses": responses(view, method, parameters),
+            }
+            if parameters:
+                operation["parameters"] = parameters
+            if method in ("POST", "PUT"):
+                operation["requestBody"] = getattr(view, 'openapi_request_body', {
+                    "content": {"application/json": {"schema": {"type": "object"}}}})
+            paths.setdefault(path, {})[method.lower()] = operation
+
+    return {
+        "openapi": "3.0.3",
+        "info": {"title": "Instagram API", "version": "1.0"},
+        "paths": paths,
+    }
+
+def generate_openapi_json(app):
+    return json.dumps(generate_openapi(app), indent=2)
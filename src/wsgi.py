@@ -1,7 +1,12 @@
 # This file was created to run the application on heroku using gunicorn.
 # Read more about it here: https://devcenter.heroku.com/articles/python-gunicorn
 
-from app import app as application
+# The app is built once here, run gunicorn with --preload so the workers are forked
+# from a master that already imported everything instead of each worker doing it again.
+# No database connection is opened while building the app, so forking it is safe.
+from app import create_app
+
+application = create_app()
 
 if __name__ == "__main__":
     application.run()
@@ -0,0 +1,38 @@
+import os
+import sys
+import pytest
+
+# the modules of the API import each other by name, as when running from src/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "src"))
+
+from app import create_app  # noqa: E402
+from models import db, User  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path}/main.db",
+        "SHARD_DATABASE_URLS": [f"sqlite:///{tmp_path}/shard{index}.db" for index in range(3)],
+        "MEDIA_ROOT": str(tmp_path / "media"),
+        "ENABLE_ADMIN": False,
+        "RATELIMIT_ENABLED": False,
+    })
+    with app.app_context():
+        db.create_all()
+        for index in range(1, 5):
+            db.session.add(User(username=f"user{index}", password="secret",
+                                email=f"user{index}@example.com"))
+        db.session.commit()
+    result = app.test_cli_runner().invoke(args=["shards-init"])
+    assert result.exit_code == 0, result.output
+    yield app
+    with app.app_context():
+        db.engine.dispose()
+        for engine in app.extensions["shard_engines"]:
+            engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,163 @@
+import io
+import os
+import pytest
+from sqlalchemy import select, text
+from outbox import OutboxWorker
+from sharding import shards, ID_RANGE
+import sharding
+
+
+def create_post(client, user_id, media_url="https://example.com/image.jpg"):
+    response = client.post("/posts", json={
+        "description": "a post", "media_url": media_url, "user_id": user_id})
+    assert response.status_code == 201, response.json
+    return response.json
+
+
+def png(width=800, height=400):
+    Image = pytest.importorskip("PIL.Image")
+    data = io.BytesIO()
+    Image.new("RGB", (width, height), "red").save(data, "PNG")
+    data.seek(0)
+    return data
+
+
+def test_shards_init_sets_the_id_range_of_every_shard(app):
+    with app.app_context():
+        for index, engine in enumerate(shards.engines):
+            with engine.connect() as connection:
+                sequences = dict(connection.execute(
+                    text("SELECT name, seq FROM sqlite_sequence")).all())
+            for table in (sharding.posts, sharding.comments):
+                # the first shard starts at 1, sqlite only has a sequence after the first insert
+                assert sequences.get(table.name, 0) == index * ID_RANGE
+
+
+def test_shards_init_does_not_reset_the_ids(app, client):
+    create_post(client, 1)
+    assert app.test_cli_runner().invoke(args=["shards-init"]).exit_code == 0
+    assert create_post(client, 1)["id"] == ID_RANGE + 2
+
+
+def test_posts_are_routed_by_user_and_found_by_id(app, client):
+    # 3 shards: user 3 goes to shard 0, user 1 to shard 1 and user 2 to shard 2
+    assert create_post(client, 3)["id"] == 1
+    assert create_post(client, 1)["id"] == ID_RANGE + 1
+    assert create_post(client, 2)["id"] == 2 * ID_RANGE + 1
+    with app.app_context():
+        assert shards.for_id(ID_RANGE) is shards.engines[0]
+        assert shards.for_id(ID_RANGE + 1) is shards.engines[1]
+        assert shards.for_id(0) is None
+        assert shards.for_id(3 * ID_RANGE + 1) is None
+    assert client.get(f"/posts/{2 * ID_RANGE + 1}").json["user"] == "user2"
+    assert client.get(f"/posts/{3 * ID_RANGE + 1}").status_code == 404
+
+
+def test_comments_and_likes_are_saved_in_the_shard_of_the_post(app, client):
+    post = create_post(client, 1)
+    comment = client.post(f"/posts/{post['id']}/comments", json={"text": "hi", "user_id": "2"})
+    assert comment.status_code == 201
+    assert comment.json["id"] == ID_RANGE + 1
+    assert client.post("/users/2/like", json={"post_id": post["id"]}).status_code == 200
+
+    post = client.get(f"/posts/{post['id']}").json
+    assert post["comments"] == ["hi"]
+    assert post["liked_by"] == ["user2"]
+
+
+def test_posts_of_all_the_shards_are_merged_newest_first(client):
+    ids = [create_post(client, user_id)["id"] for user_id in (1, 2, 3, 1, 3, 2)]
+    posts = client.get("/posts").json
+    assert [post["id"] for post in posts] == list(reversed(ids))
+
+
+def test_user_posts_come_from_the_shard_of_the_user(client):
+    ids = [create_post(client, 1)["id"] for _ in range(2)]
+    create_post(client, 2)
+    assert client.get("/users/1").json["posts"] == ids
+    assert [post["id"] for post in client.get("/users/1/posts").json] == list(reversed(ids))
+
+
+def test_the_event_is_saved_in_the_outbox_of_the_shard(app, client):
+    post = create_post(client, 1)
+    with app.app_context():
+        with shards.engines[1].connect() as connection:
+            events = connection.execute(select(sharding.outbox)).mappings().all()
+    assert [(event["entity_id"], event["event_type"]) for event in events] == [
+        (post["id"], "post.created")]
+
+
+def test_thumbnails_are_generated_by_the_outbox_worker(app, client):
+    upload = client.post("/media", data={"file": (png(), "image.png")})
+    assert upload.status_code == 201
+    post = create_post(client, 1, upload.json["media_url"])
+    assert post["media_variants"] == {}
+
+    assert OutboxWorker(app).run_once() == 1
+    post = client.get(f"/posts/{post['id']}").json
+    assert (post["media_width"], post["media_height"]) == (800, 400)
+    assert set(post["media_variants"]) == {"small", "medium"}
+    for url in post["media_variants"].values():
+        assert os.path.exists(os.path.join(app.config["MEDIA_ROOT"], "thumbnails",
+                                           os.path.basename(url)))
+        assert client.get(url).status_code == 200
+
+
+def test_the_same_image_is_saved_once(app, client):
+    first = client.post("/media", data={"file": (png(), "a.png")}).json["media_url"]
+    second = client.post("/media", data={"file": (png(), "b.png")}).json["media_url"]
+    assert first == second
+    assert os.listdir(app.config["MEDIA_ROOT"]) == [os.path.basename(first)]
+
+
+@pytest.mark.parametrize("method, url, body", [
+    ("post", "/posts", {"description": "a", "media_url": "https://example.com/a.jpg",
+                        "user_id": 99}),
+    ("post", "/posts/POST_ID/comments", {"text": "hi", "user_id": 99}),
+    ("put", "/posts/POST_ID", {"user_id": 99}),
+])
+def test_unknown_users_are_not_saved(app, client, method, url, body):
+    post = create_post(client, 1)
+    response = getattr(client, method)(url.replace("POST_ID", str(post["id"])), json=body)
+    assert response.status_code == 404
+    assert response.json["message"] == "User not found"
+    assert client.get(f"/posts/{post['id']}").json["comments"] == []
+    assert len(client.get("/posts").json) == 1
+
+
+@pytest.mark.parametrize("body", [
+    {"description": "a", "media_url": "https://example.com/a.jpg", "user_id": "one"},
+    {"description": "a", "media_url": "/media/../../etc/passwd", "user_id": 1},
+    {"description": "a", "media_url": "ftp://example.com/a.jpg", "user_id": 1},
+])
+def test_invalid_posts_are_rejected(client, body):
+    assert client.post("/posts", json=body).status_code == 400
+
+
+@pytest.mark.parametrize("query", ["days=abc", "days=-1", "days=3651", "days=1000000"])
+def test_invalid_stats_days(client, query):
+    assert client.get(f"/users/1/stats?{query}").status_code == 400
+
+
+@pytest.mark.parametrize("body", [
+    {"user_ids": [1], "days": 10000000},
+    {"user_ids": [1], "days": "7"},
+    {"user_ids": ["1"]},
+    {"user_ids": list(range(101))},
+])
+def test_invalid_stats_batch(client, body):
+    assert client.post("/users/stats:batch", json=body).status_code == 400
+
+
+def test_stats_count_the_rows_of_every_shard(client):
+    post = create_post(client, 1)
+    create_post(client, 1)
+    client.post(f"/posts/{post['id']}/comments", json={"text": "hi", "user_id": 2})
+    client.post("/users/2/like", json={"post_id": post["id"]})
+
+    stats = client.post("/users/stats:batch", json={"user_ids": [1, 2, 99]}).json
+    assert stats["not_found"] == [99]
+    first, second = stats["stats"]
+    assert (first["posts"], first["likes_received"]) == (2, 1)
+    assert (second["comments"], second["likes_given"]) == (1, 1)
+    assert client.get("/users/99/stats").status_code == 404